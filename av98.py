@@ -9,34 +9,34 @@
 #  - Klaus Alexander Seistrup <klaus@seistrup.dk>
 #  - govynnus <govynnus@sdf.org>
 
-import argparse
+import atexit
 import cmd
-import cgi
 import codecs
 import collections
 import datetime
 import fnmatch
-import getpass
-import glob
+import functools
 import hashlib
-import io
-import mimetypes
 import os
 import os.path
-import random
+import queue
+import re
 import shlex
 import shutil
+import signal
 import socket
-import sqlite3
 import ssl
 from ssl import CertificateError
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import types
 import urllib.parse
-import uuid
-import webbrowser
+# argparse, cgi, getpass, sqlite3, uuid and webbrowser are imported where
+# they are used, as they're slow to import and many sessions need few or none
+# of them.
 
 try:
     import ansiwrap as textwrap
@@ -54,8 +54,32 @@ except ModuleNotFoundError:
 _VERSION = "1.0.2dev"
 
 _MAX_REDIRECTS = 5
+_DNS_CACHE_TTL_SECS = 60
+_RECV_BUFFER_SIZE = 65536
+_HAPPY_EYEBALLS_DELAY = 0.25
 _MAX_CACHE_SIZE = 10
 _MAX_CACHE_AGE_SECS = 180
+_MAX_TOFU_CACHE_SIZE = 512
+_TOFU_BATCH_SIZE = 32
+
+# TOFU database queries, kept as constants so that sqlite3's statement cache
+# only ever has to prepare each of them once per connection.
+_SQL_SELECT_CERT = """SELECT count
+    FROM cert_cache
+    WHERE hostname=? AND address=? AND fingerprint=?"""
+_SQL_SELECT_MOST_FREQUENT_CERT = """SELECT fingerprint, count
+    FROM cert_cache
+    WHERE hostname=? AND address=?
+    ORDER BY count DESC, rowid
+    LIMIT 1"""
+_SQL_TOUCH_CERT = """UPDATE cert_cache
+    SET last_seen=?, count=count+1
+    WHERE hostname=? AND address=? AND fingerprint=?"""
+_SQL_INSERT_CERT = """INSERT INTO cert_cache
+    VALUES (?, ?, ?, ?, ?, ?)"""
+
+# rcfile commands which are skipped if a URL or --bookmarks is given
+_RC_NAV_PREFIXES = ("go", "g", "tour", "t")
 
 # Command abbreviations
 _ABBREVS = {
@@ -91,6 +115,24 @@ _MIME_HANDLERS = {
     "text/*":               "cat %s",
 }
 
+def _compile_mime_handlers():
+    """
+    Split _MIME_HANDLERS into a dict of exact matches and a list of
+    (compiled regex, command) pairs for wildcard matches.  Must be called
+    again whenever _MIME_HANDLERS changes.
+    """
+    global _MIME_EXACT, _MIME_WILDCARDS
+    _MIME_EXACT = {}
+    _MIME_WILDCARDS = []
+    for handled_mime, cmd_str in _MIME_HANDLERS.items():
+        if "*" in handled_mime:
+            pattern = re.compile(fnmatch.translate(handled_mime))
+            _MIME_WILDCARDS.append((pattern, cmd_str))
+        else:
+            _MIME_EXACT[handled_mime] = cmd_str
+
+_compile_mime_handlers()
+
 # monkey-patch Gemini support in urllib.parse
 # see https://github.com/python/cpython/blob/master/Lib/urllib/parse.py
 urllib.parse.uses_relative.append("gemini")
@@ -103,18 +145,21 @@ def fix_ipv6_url(url):
     # If there's a pair of []s in there, it's probably fine as is.
     if "[" in url and "]" in url:
         return url
+    # Find the schema and the first slash after it in one go, rather than
+    # repeatedly scanning the whole URL for each case below.
+    schema_end = url.find("://")
+    if schema_end == -1:
+        schema, schemaless = None, url
+    else:
+        schema, schemaless = url[:schema_end], url[schema_end+3:]
+    slash = schemaless.find("/")
     # Easiest case is a raw address, no schema, no path.
     # Just wrap it in square brackets and whack a slash on the end
-    if "/" not in url:
+    if slash == -1 and not schema:
         return "[" + url + "]/"
     # Now the trickier cases...
-    if "://" in url:
-        schema, schemaless = url.split("://")
-    else:
-        schema, schemaless = None, url
-    if "/" in schemaless:
-        netloc, rest = schemaless.split("/",1)
-        schemaless = "[" + netloc + "]" + "/" + rest
+    if slash != -1:
+        schemaless = "[" + schemaless[:slash] + "]" + schemaless[slash:]
     if schema:
         return schema + "://" + schemaless
     return schemaless
@@ -124,6 +169,49 @@ standard_ports = {
         "gopher": 70,
 }
 
+# The same handful of URLs get parsed over and over again while rendering
+# menus, walking history, etc., so memoise the expensive bits of urllib.parse.
+@functools.lru_cache(maxsize=2048)
+def _parse_url(url):
+    parsed = urllib.parse.urlparse(url)
+    # Links on a page overwhelmingly share a scheme and host, so have all
+    # GeminiItems share single copies of those strings
+    host = parsed.hostname
+    if host:
+        host = sys.intern(host)
+    return sys.intern(parsed.scheme), host, parsed.port, parsed.path
+
+@functools.lru_cache(maxsize=2048)
+def _urljoin(base, url):
+    return urllib.parse.urljoin(base, url)
+
+# ANSI styling for gemtext headers: bold+underline, bold, underline
+_ANSI_H1_FMT = "\x1b[1m\x1b[4m%s\x1b[0m"
+_ANSI_H2_FMT = "\x1b[1m%s\x1b[0m"
+_ANSI_H3_FMT = "\x1b[4m%s\x1b[0m"
+
+# Classifies a line of text/gemini by its line type prefix (if any) and
+# separates out the text following the prefix, all in a single match.
+_LINE_RE = re.compile(r"(```|=>|\* |>|#{1,3})?[\t ]*(.*)", re.DOTALL)
+
+def _iter_lines(text):
+    """
+    Yield the lines of `text` (ending in LF or CRLF) one at a time, without
+    building a list of all of them first like str.splitlines() would.
+    """
+    pos = 0
+    end = len(text)
+    find = text.find
+    while pos < end:
+        newline = find("\n", pos)
+        if newline == -1:
+            newline = end
+        line_end = newline
+        if line_end > pos and text[line_end-1] == "\r":
+            line_end -= 1
+        yield text[pos:line_end]
+        pos = newline + 1
+
 class GeminiItem():
 
     def __init__(self, url, name=""):
@@ -131,23 +219,36 @@ class GeminiItem():
             url = "gemini://" + url
         self.url = fix_ipv6_url(url)
         self.name = name
-        parsed = urllib.parse.urlparse(self.url)
-        self.scheme = parsed.scheme
-        self.host = parsed.hostname
-        self.port = parsed.port or standard_ports.get(self.scheme, 0)
-        self.path = parsed.path
+        self._name_lower = None
+        self.scheme, self.host, port, self.path = _parse_url(self.url)
+        self.port = port or standard_ports.get(self.scheme, 0)
+        # Avoid inserting standard ports into derived URLs, to keep them clean
+        if self.port == standard_ports.get(self.scheme, 0):
+            self._netloc = self.host
+        else:
+            self._netloc = "{}:{}".format(self.host, self.port)
+
+    @property
+    def name_lower(self):
+        """
+        Lower case version of the name, for case insensitive searching.
+        Worked out the first time it's needed and remembered after that.
+        """
+        if self._name_lower is None:
+            self._name_lower = self.name.lower()
+        return self._name_lower
 
     def root(self):
         return GeminiItem(self._derive_url("/"))
 
     def up(self):
-        pathbits = list(os.path.split(self.path.rstrip('/')))
+        # URL paths always use /, whatever os.path thinks
+        path = self.path.rstrip('/')
         # Don't try to go higher than root
-        if len(pathbits) == 1:
+        if not path:
             return self
         # Get rid of bottom component
-        pathbits.pop()
-        new_path = os.path.join(*pathbits)
+        new_path = path[:path.rfind('/')+1] or "/"
         return GeminiItem(self._derive_url(new_path))
 
     def query(self, query):
@@ -159,8 +260,7 @@ class GeminiItem():
         A thin wrapper around urlunparse which avoids inserting standard ports
         into URLs just to keep things clean.
         """
-        return urllib.parse.urlunparse((self.scheme,
-            self.host if self.port == standard_ports[self.scheme] else self.host + ":" + str(self.port),
+        return urllib.parse.urlunparse((self.scheme, self._netloc,
             path or self.path, "", query, ""))
 
     def absolutise_url(self, relative_url):
@@ -168,7 +268,7 @@ class GeminiItem():
         Convert a relative URL to an absolute URL by using the URL of this
         GeminiItem as a base.
         """
-        return urllib.parse.urljoin(self.url, relative_url)
+        return _urljoin(self.url, relative_url)
 
     def to_map_line(self, name=None):
         if name or self.name:
@@ -178,9 +278,10 @@ class GeminiItem():
 
     @classmethod
     def from_map_line(cls, line, origin_gi):
-        assert line.startswith("=>")
-        assert line[2:].strip()
-        bits = line[2:].strip().split(maxsplit=1)
+        line_type, text = _LINE_RE.match(line).groups()
+        assert line_type == "=>"
+        bits = text.split(maxsplit=1)
+        assert bits
         bits[0] = origin_gi.absolutise_url(bits[0])
         return cls(*bits)
 
@@ -188,7 +289,8 @@ CRLF = '\r\n'
 
 # Cheap and cheerful URL detector
 def looks_like_url(word):
-    return "." in word and word.startswith("gemini://")
+    # The prefix test rejects almost everything, so do it first
+    return word.startswith("gemini://") and "." in word
 
 class UserAbortException(Exception):
     pass
@@ -239,6 +341,18 @@ class GeminiClient(cmd.Cmd):
                 self.config_dir = os.path.expanduser("~/.av98/")
             print("Creating config directory {}".format(self.config_dir))
             os.makedirs(self.config_dir)
+        ## Work out where things live inside it once and for all
+        self.bookmarks_file = os.path.join(self.config_dir, "bookmarks.gmi")
+        self.rc_file = os.path.join(self.config_dir, "av98rc")
+        self.tofu_db_file = os.path.join(self.config_dir, "tofu.db")
+        self.cert_cache_dir = os.path.join(self.config_dir, "cert_cache")
+        self.client_certs_dir = os.path.join(self.config_dir, "client_certs")
+        self.transient_certs_dir = os.path.join(self.config_dir, "transient_certs")
+        # Make sure the certificate directories exist now, so that nothing
+        # needs to check before writing to them later
+        for certdir in (self.cert_cache_dir, self.client_certs_dir,
+                self.transient_certs_dir):
+            os.makedirs(certdir, exist_ok=True)
 
         self.no_cert_prompt = "\x1b[38;5;76m" + "AV-98" + "\x1b[38;5;255m" + "> " + "\x1b[0m"
         self.cert_prompt = "\x1b[38;5;202m" + "AV-98" + "\x1b[38;5;255m" + "+cert> " + "\x1b[0m"
@@ -256,6 +370,8 @@ class GeminiClient(cmd.Cmd):
         self.previous_redirectors = set()
         self.restricted = restricted
         self.tmp_filename = ""
+        self.unsaved_body = None
+        self.fillers = {}
         self.visited_hosts = set()
         self.waypoints = []
 
@@ -274,8 +390,10 @@ class GeminiClient(cmd.Cmd):
             "auto_follow_redirects" : True,
             "gopher_proxy" : None,
             "tls_mode" : "tofu",
-            "cache" : False
+            "cache" : False,
+            "happy_eyeballs" : False
         }
+        self._set_debug(self.options["debug"])
 
         self.log = {
             "start_time": time.time(),
@@ -285,6 +403,8 @@ class GeminiClient(cmd.Cmd):
             "bytes_recvd": 0,
             "ipv4_bytes_recvd": 0,
             "ipv6_bytes_recvd": 0,
+            "ipv4_hosts": 0,
+            "ipv6_hosts": 0,
             "dns_failures": 0,
             "refused_connections": 0,
             "reset_connections": 0,
@@ -292,20 +412,50 @@ class GeminiClient(cmd.Cmd):
             "cache_hits": 0,
         }
 
-        self._connect_to_tofu_db()
-
-        self.cache = {}
-        self.cache_timestamps = {}
+        # The TOFU DB is only opened when a certificate first needs checking,
+        # so quick sessions and CA mode never pay for it
+        self.db_conn = None
+        self.db_cur = None
+        atexit.register(self._cleanup)
+
+        # url -> (mime, filename, timestamp), least recently used first
+        self.cache = collections.OrderedDict()
+        # (hostname, address) -> fingerprint of certificates accepted during
+        # this session, so revisits don't have to search the TOFU DB
+        self.tofu_cache = collections.OrderedDict()
+        self.tofu_pending_touches = []
+        # fingerprint -> expiry date of previously seen certificates
+        self.cert_expiry_cache = {}
+
+        # Reusable TLS contexts (per TLS mode and client certificate) and
+        # resumable sessions
+        self.ssl_contexts = {}
+        self.client_cert_contexts = {}
+        self.tls_sessions = {}
+        # (host, port) -> (family mask, addresses, expiry time)
+        self.dns_cache = {}
 
     def _connect_to_tofu_db(self):
 
-        db_path = os.path.join(self.config_dir, "tofu.db")
-        self.db_conn = sqlite3.connect(db_path)
+        import sqlite3
+        self.db_conn = sqlite3.connect(self.tofu_db_file, cached_statements=128)
         self.db_cur = self.db_conn.cursor()
 
         self.db_cur.execute("""CREATE TABLE IF NOT EXISTS cert_cache
             (hostname text, address text, fingerprint text,
             first_seen date, last_seen date, count integer)""")
+        # Every fetch looks certificates up by hostname, address and
+        # fingerprint.  This isn't a UNIQUE index in case old databases
+        # contain duplicates.
+        self.db_cur.execute("""CREATE INDEX IF NOT EXISTS idx_cert_cache_host_addr_fp
+            ON cert_cache (hostname, address, fingerprint)""")
+
+        # The TOFU DB is hit on every request, so favour speed over paranoia:
+        # with a write-ahead log, NORMAL sync means commits don't fsync.
+        self.db_cur.execute("PRAGMA journal_mode=WAL")
+        self.db_cur.execute("PRAGMA synchronous=NORMAL")
+        self.db_cur.execute("PRAGMA cache_size=-16384")
+        self.db_cur.execute("PRAGMA temp_store=MEMORY")
 
     def _go_to_gi(self, gi, update_hist=True, check_cache=True, handle=True):
         """This method might be considered "the heart of AV-98".
@@ -316,6 +466,7 @@ class GeminiClient(cmd.Cmd):
 
         # Don't try to speak to servers running other protocols
         if gi.scheme in ("http", "https"):
+            import webbrowser
             webbrowser.open_new_tab(gi.url)
             return
         elif gi.scheme == "gopher" and not self.options.get("gopher_proxy", None):
@@ -337,6 +488,7 @@ you'll be able to transparently follow links to Gopherspace!""")
         # Use cache, or hit the network if resource is not cached
         if check_cache and self.options["cache"] and self._is_cached(gi.url):
             mime, body, tmpfile = self._get_cached(gi.url)
+            self.tmp_filename, self.unsaved_body = tmpfile, None
         else:
             try:
                 gi, mime, body, tmpfile = self._fetch_over_network(gi)
@@ -421,34 +573,42 @@ you'll be able to transparently follow links to Gopherspace!""")
         # Spec dictates <META> should not exceed 1024 bytes,
         # so maximum valid header length is 1027 bytes.
         header = f.readline(1027)
-        header = header.decode("UTF-8")
-        if not header or header[-1] != '\n':
+        self._debug("Response header: %r." % header)
+        if not header.endswith(b"\n"):
             raise RuntimeError("Received invalid header from server!")
-        header = header.strip()
-        self._debug("Response header: %s." % header)
 
         # Validate header
-        status, meta = header.split(maxsplit=1)
-        if len(meta) > 1024 or len(status) != 2 or not status.isnumeric():
+        # The status code is plain ASCII, so keep it as bytes and only decode
+        # the <META>
+        status, meta = (header.strip().split(maxsplit=1) + [b""])[:2]
+        if len(meta) > 1024 or len(status) != 2 or not status.isdigit():
             f.close()
             raise RuntimeError("Received invalid header from server!")
+        meta = meta.decode("UTF-8")
 
         # Update redirect loop/maze escaping state
-        if not status.startswith("3"):
+        if not status.startswith(b"3"):
             self.previous_redirectors = set()
 
+        # Only SUCCESS responses have a body, so for anything else we're
+        # done with the connection already - don't hold it open while
+        # following redirects, prompting the user, etc.
+        if not status.startswith(b"2"):
+            f.close()
+
         # Handle non-SUCCESS headers, which don't have a response body
         # Inputs
-        if status.startswith("1"):
+        if status.startswith(b"1"):
             print(meta)
-            if status == "11":
+            if status == b"11":
+                import getpass
                 user_input = getpass.getpass("> ")
             else:
                 user_input = input("> ")
             return self._fetch_over_network(gi.query(user_input))
 
         # Redirects
-        elif status.startswith("3"):
+        elif status.startswith(b"3"):
             new_gi = GeminiItem(gi.absolutise_url(meta))
             if new_gi.url == gi.url:
                 raise RuntimeError("URL redirects to itself!")
@@ -473,30 +633,31 @@ you'll be able to transparently follow links to Gopherspace!""")
             self._debug("Following redirect to %s." % new_gi.url)
             self._debug("This is consecutive redirect number %d." % len(self.previous_redirectors))
             self.previous_redirectors.add(gi.url)
-            if status == "31":
+            if status == b"31":
                 # Permanent redirect
                 self.permanent_redirects[gi.url] = new_gi.url
             return self._fetch_over_network(new_gi)
 
         # Errors
-        elif status.startswith("4") or status.startswith("5"):
+        elif status.startswith((b"4", b"5")):
             raise RuntimeError(meta)
 
         # Client cert
-        elif status.startswith("6"):
-            self._handle_cert_request(meta)
+        elif status.startswith(b"6"):
+            self._handle_cert_request(gi, status, meta)
             return self._fetch_over_network(gi)
 
         # Invalid status
-        elif not status.startswith("2"):
-            raise RuntimeError("Server returned undefined status code %s!" % status)
+        elif not status.startswith(b"2"):
+            raise RuntimeError("Server returned undefined status code %s!" % status.decode("ascii"))
 
         # If we're here, this must be a success and there's a response body
-        assert status.startswith("2")
+        assert status.startswith(b"2")
 
         mime = meta
         if mime == "":
             mime = "text/gemini; charset=utf-8"
+        import cgi
         mime, mime_options = cgi.parse_header(mime)
         if "charset" in mime_options:
             try:
@@ -504,27 +665,37 @@ you'll be able to transparently follow links to Gopherspace!""")
             except LookupError:
                 raise RuntimeError("Header declared unknown encoding %s" % value)
 
-        # Read the response body over the network
-        body = f.read()
-
         # Save the result in a temporary file
-        ## Set file mode
         if mime.startswith("text/"):
-            mode = "w"
+            # Text needs decoding (and text/gemini needs parsing), so read
+            # the whole body into memory
+            raw_body = f.read()
+            f.close()
+            size = len(raw_body)
             encoding = mime_options.get("charset", "UTF-8")
             try:
-                body = body.decode(encoding)
+                body = raw_body.decode(encoding)
             except UnicodeError:
                 raise RuntimeError("Could not decode response body using %s encoding declared in header!" % encoding)
+            if mime == "text/gemini" and not self.options["cache"]:
+                # Gemtext is rendered straight from memory, so only write it
+                # to disk if something asks for it later
+                self.tmp_filename = ""
+                self.unsaved_body = raw_body
+            else:
+                self._write_tmp_file(raw_body)
         else:
-            mode = "wb"
-            encoding = None
-        ## Write
-        tmpf = tempfile.NamedTemporaryFile(mode, encoding=encoding, delete=False)
-        size = tmpf.write(body)
-        tmpf.close()
-        self.tmp_filename = tmpf.name
-        self._debug("Wrote %d byte response to %s." % (size, self.tmp_filename))
+            # Anything else is only ever passed to a handler program, so
+            # stream it straight to disk without buffering it all in memory
+            body = None
+            tmpf = tempfile.NamedTemporaryFile("wb", delete=False)
+            shutil.copyfileobj(f, tmpf, _RECV_BUFFER_SIZE)
+            f.close()
+            size = tmpf.tell()
+            tmpf.close()
+            self.tmp_filename = tmpf.name
+            self.unsaved_body = None
+            self._debug("Wrote %d byte response to %s." % (size, self.tmp_filename))
 
         # Maintain cache and log
         if self.options["cache"]:
@@ -533,6 +704,23 @@ you'll be able to transparently follow links to Gopherspace!""")
 
         return gi, mime, body, self.tmp_filename
 
+    def _write_tmp_file(self, raw_body):
+        tmpf = tempfile.NamedTemporaryFile("wb", delete=False)
+        size = tmpf.write(raw_body)
+        tmpf.close()
+        self.tmp_filename = tmpf.name
+        self.unsaved_body = None
+        self._debug("Wrote %d byte response to %s." % (size, self.tmp_filename))
+
+    def _get_tmp_file(self):
+        """
+        Return the name of a file holding the body of the most recently
+        fetched item, first writing it to disk if it was only kept in memory.
+        """
+        if self.unsaved_body is not None:
+            self._write_tmp_file(self.unsaved_body)
+        return self.tmp_filename
+
     def _send_request(self, gi):
         """Send a selector to a given host and port.
         Returns the resolved address and binary file with the reply."""
@@ -547,11 +735,151 @@ you'll be able to transparently follow links to Gopherspace!""")
         # Do DNS resolution
         addresses = self._get_addresses(host, port)
 
-        # Prepare TLS context
+        # Prepare TLS context, resuming an earlier session with this server
+        # if we have one and aren't presenting a client certificate
+        context = self._get_ssl_context()
+        if self.client_certs["active"]:
+            session_key = None
+        else:
+            session_key = (self.options["tls_mode"], host, port)
+        session = self.tls_sessions.get(session_key)
+
+        # Connect to remote host by any address possible
+        if self.options["happy_eyeballs"] and len(addresses) > 1:
+            try:
+                address, s = self._race_connections(addresses)
+            except OSError:
+                # Don't keep trying addresses which may have gone stale
+                self.dns_cache.pop((host, port), None)
+                raise
+            s = context.wrap_socket(s, server_hostname = gi.host, session = session)
+        else:
+            err = None
+            for address in addresses:
+                self._debug("Connecting to: " + str(address[4]))
+                s = socket.socket(address[0], address[1])
+                s.settimeout(self.options["timeout"])
+                s = context.wrap_socket(s, server_hostname = gi.host, session = session)
+                try:
+                    s.connect(address[4])
+                    break
+                except OSError as e:
+                    err = e
+            else:
+                # If we couldn't connect to *any* of the addresses, just
+                # bubble up the exception from the last attempt and deny
+                # knowledge of earlier failures.  Don't keep trying
+                # addresses which may have gone stale, either.
+                self.dns_cache.pop((host, port), None)
+                raise err
+
+        if sys.version_info.minor >=5:
+            self._debug("Established {} connection.".format(s.version()))
+        self._debug("Cipher is: {}.".format(s.cipher()))
+        if s.session_reused:
+            self._debug("Resumed previous TLS session.")
+
+        # Do TOFU
+        if self.options["tls_mode"] != "ca":
+            cert = s.getpeercert(binary_form=True)
+            self._validate_cert(address[4][0], host, cert)
+
+        # Remember that we showed the current cert to this domain...
+        if self.client_certs["active"]:
+            self.active_cert_domains.append(gi.host)
+            self.client_certs[gi.host] = self.client_certs["active"]
+
+        # Send request and wrap response in a file descriptor
+        self._debug("Sending %s<CRLF>" % gi.url)
+        s.sendall((gi.url + CRLF).encode("UTF-8"))
+        f = s.makefile(mode = "rb", buffering = _RECV_BUFFER_SIZE)
+        # TLS 1.3 servers only issue session tickets after the handshake, so
+        # wait for the response to start arriving before saving the session
+        if session_key:
+            f.peek(1)
+            self.tls_sessions[session_key] = s.session
+        return address, f
+
+    def _race_connections(self, addresses):
+        """
+        Connect to the first of several addresses which answers, in the style
+        of RFC 8305 "Happy Eyeballs".  Connection attempts are started in
+        order, with a new one starting whenever the previous one fails or
+        has been pending for a short while, so that an unreachable address
+        doesn't hold everything up until it times out.  Returns the winning
+        address and a connected (non-TLS) socket.
+        """
+        results = queue.Queue()
+        lock = threading.Lock()
+        winner = []
+
+        def attempt(address):
+            s = socket.socket(address[0], address[1])
+            s.settimeout(self.options["timeout"])
+            try:
+                s.connect(address[4])
+            except OSError as e:
+                s.close()
+                results.put(e)
+                return
+            with lock:
+                if winner:
+                    # Too slow, another attempt already won
+                    s.close()
+                    return
+                winner.append((address, s))
+            results.put(None)
+
+        err = None
+        started = failed = 0
+        while failed < len(addresses):
+            if started < len(addresses):
+                address = addresses[started]
+                self._debug("Connecting to: " + str(address[4]))
+                threading.Thread(target=attempt, args=(address,), daemon=True).start()
+                started += 1
+            if started < len(addresses):
+                timeout = _HAPPY_EYEBALLS_DELAY
+            else:
+                timeout = None
+            try:
+                result = results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if result is None:
+                return winner[0]
+            err = result
+            failed += 1
+        # As in the serial case, only the last failure gets reported
+        raise err
+
+    def _get_ssl_context(self):
+        """
+        Return an SSLContext suitable for the current TLS mode and client
+        certificate.  Contexts are built once and reused, which saves
+        reloading CA certificates and client certificates for every request
+        and lets sessions from previous connections be resumed.
+        """
+        tls_mode = self.options["tls_mode"]
+        if self.client_certs["active"]:
+            # Also key on the certificate's mtime so that a certificate which
+            # has been regenerated in place gets reloaded
+            certfile, keyfile = self.client_certs["active"]
+            key = (tls_mode, certfile, keyfile, os.stat(certfile).st_mtime)
+            if key not in self.client_cert_contexts:
+                context = self._build_ssl_context(tls_mode)
+                context.load_cert_chain(certfile, keyfile)
+                self.client_cert_contexts[key] = context
+            return self.client_cert_contexts[key]
+        if tls_mode not in self.ssl_contexts:
+            self.ssl_contexts[tls_mode] = self._build_ssl_context(tls_mode)
+        return self.ssl_contexts[tls_mode]
+
+    def _build_ssl_context(self, tls_mode):
         protocol = ssl.PROTOCOL_TLS if sys.version_info.minor >=6 else ssl.PROTOCOL_TLSv1_2
         context = ssl.SSLContext(protocol)
         # Use CAs or TOFU
-        if self.options["tls_mode"] == "ca":
+        if tls_mode == "ca":
             context.verify_mode = ssl.CERT_REQUIRED
             context.check_hostname = True
             context.load_default_certs()
@@ -575,47 +903,7 @@ you'll be able to transparently follow links to Gopherspace!""")
         except ssl.SSLError:
             # Rely on the server to only support sensible things, I guess...
             pass
-        # Load client certificate if needed
-        if self.client_certs["active"]:
-            certfile, keyfile = self.client_certs["active"]
-            context.load_cert_chain(certfile, keyfile)
-
-        # Connect to remote host by any address possible
-        err = None
-        for address in addresses:
-            self._debug("Connecting to: " + str(address[4]))
-            s = socket.socket(address[0], address[1])
-            s.settimeout(self.options["timeout"])
-            s = context.wrap_socket(s, server_hostname = gi.host)
-            try:
-                s.connect(address[4])
-                break
-            except OSError as e:
-                err = e
-        else:
-            # If we couldn't connect to *any* of the addresses, just
-            # bubble up the exception from the last attempt and deny
-            # knowledge of earlier failures.
-            raise err
-
-        if sys.version_info.minor >=5:
-            self._debug("Established {} connection.".format(s.version()))
-        self._debug("Cipher is: {}.".format(s.cipher()))
-
-        # Do TOFU
-        if self.options["tls_mode"] != "ca":
-            cert = s.getpeercert(binary_form=True)
-            self._validate_cert(address[4][0], host, cert)
-
-        # Remember that we showed the current cert to this domain...
-        if self.client_certs["active"]:
-            self.active_cert_domains.append(gi.host)
-            self.client_certs[gi.host] = self.client_certs["active"]
-
-        # Send request and wrap response in a file descriptor
-        self._debug("Sending %s<CRLF>" % gi.url)
-        s.sendall((gi.url + CRLF).encode("UTF-8"))
-        return address, s.makefile(mode = "rb")
+        return context
 
     def _get_addresses(self, host, port):
         # DNS lookup - will get IPv4 and IPv6 records if IPv6 is enabled
@@ -629,10 +917,22 @@ you'll be able to transparently follow links to Gopherspace!""")
         else:
             # IPv4 only
             family_mask = socket.AF_INET
+        # Reuse recent lookups, so that e.g. following several links on the
+        # same capsule doesn't cost a trip to the resolver each time
+        cached = self.dns_cache.get((host, port))
+        if cached:
+            cached_mask, addresses, expiry = cached
+            if cached_mask == family_mask and time.time() < expiry:
+                self._debug("Using cached addresses for {}.".format(host))
+                return addresses
         addresses = socket.getaddrinfo(host, port, family=family_mask,
                 type=socket.SOCK_STREAM)
-        # Sort addresses so IPv6 ones come first
-        addresses.sort(key=lambda add: add[0] == socket.AF_INET6, reverse=True)
+        # Put IPv6 addresses first, otherwise keeping the resolver's order
+        ipv6 = [add for add in addresses if add[0] == socket.AF_INET6]
+        if ipv6 and len(ipv6) < len(addresses):
+            addresses = ipv6 + [add for add in addresses if add[0] != socket.AF_INET6]
+        self.dns_cache[(host, port)] = (family_mask, addresses,
+                time.time() + _DNS_CACHE_TTL_SECS)
 
         return addresses
 
@@ -640,7 +940,7 @@ you'll be able to transparently follow links to Gopherspace!""")
         if url not in self.cache:
             return False
         now = time.time()
-        cached = self.cache_timestamps[url]
+        _, _, cached = self.cache[url]
         if now - cached > _MAX_CACHE_AGE_SECS:
             self._debug("Expiring old cached copy of resource.")
             self._remove_from_cache(url)
@@ -649,39 +949,37 @@ you'll be able to transparently follow links to Gopherspace!""")
         return True
 
     def _remove_from_cache(self, url):
-        self.cache_timestamps.pop(url)
-        mime, filename = self.cache.pop(url)
+        mime, filename, _ = self.cache.pop(url)
         os.unlink(filename)
         self._validate_cache()
 
     def _add_to_cache(self, url, mime, filename):
 
-        self.cache_timestamps[url] = time.time()
-        self.cache[url] = (mime, filename)
+        if url in self.cache:
+            self._remove_from_cache(url)
+        self.cache[url] = (mime, filename, time.time())
         if len(self.cache) > _MAX_CACHE_SIZE:
             self._trim_cache()
         self._validate_cache()
 
     def _trim_cache(self):
-        # Order cache entries by age
-        lru = [(t, u) for (u, t) in self.cache_timestamps.items()]
-        lru.sort()
-        # Drop the oldest entry no matter what
-        _, url = lru[0]
-        self._debug("Dropping cached copy of {} from full cache.".format(url))
-        self._remove_from_cache(url)
-        # Drop other entries if they are older than the limit
+        # Drop any entries which are older than the limit.  The cache is in
+        # order of use, not of age, so every entry has to be checked.
         now = time.time()
-        for cached, url in lru[1:]:
+        for url, (_, _, cached) in list(self.cache.items()):
             if now - cached > _MAX_CACHE_AGE_SECS:
                 self._debug("Dropping cached copy of {} from full cache.".format(url))
                 self._remove_from_cache(url)
-            else:
-                break
+        # If that didn't make room, drop the least recently used entry
+        if len(self.cache) > _MAX_CACHE_SIZE:
+            url, (mime, filename, _) = self.cache.popitem(last=False)
+            self._debug("Dropping cached copy of {} from full cache.".format(url))
+            os.unlink(filename)
         self._validate_cache()
 
     def _get_cached(self, url):
-        mime, filename = self.cache[url]
+        mime, filename, _ = self.cache[url]
+        self.cache.move_to_end(url)
         self.log["cache_hits"] += 1
         if mime.startswith("text/gemini"):
             with open(filename, "r") as fp:
@@ -691,16 +989,17 @@ you'll be able to transparently follow links to Gopherspace!""")
             return mime, None, filename
 
     def _empty_cache(self):
-        for mime, filename in self.cache.values():
-            if os.path.exists(filename):
+        for mime, filename, _ in self.cache.values():
+            try:
                 os.unlink(filename)
+            except FileNotFoundError:
+                pass
 
     def _validate_cache(self):
-        assert self.cache.keys() == self.cache_timestamps.keys()
-        for _, filename in self.cache.values():
+        for _, filename, _ in self.cache.values():
             assert os.path.isfile(filename)
 
-    def _handle_cert_request(self, meta):
+    def _handle_cert_request(self, gi, status, meta):
 
         # Don't do client cert stuff in restricted mode, as in principle
         # it could be used to fill up the disk by creating a whole lot of
@@ -713,9 +1012,9 @@ you'll be able to transparently follow links to Gopherspace!""")
         print("SERVER SAYS: ", meta)
         # Present different messages for different 6x statuses, but
         # handle them the same.
-        if status in ("64", "65"):
+        if status in (b"64", b"65"):
             print("The server rejected your certificate because it is either expired or not yet valid.")
-        elif status == "63":
+        elif status == b"63":
             print("The server did not accept your certificate.")
             print("You may need to e.g. coordinate with the admin to get your certificate fingerprint whitelisted.")
         else:
@@ -789,139 +1088,173 @@ you'll be able to transparently follow links to Gopherspace!""")
                 # If we didn't break out, none of the names were valid
                 raise CertificateError("Hostname does not match certificate common name or any alternative names.")
 
-        sha = hashlib.sha256()
-        sha.update(cert)
-        fingerprint = sha.hexdigest()
-
-        # Have we been here before?
-        self.db_cur.execute("""SELECT fingerprint, first_seen, last_seen, count
-            FROM cert_cache
-            WHERE hostname=? AND address=?""", (host, address))
-        cached_certs = self.db_cur.fetchall()
-
-        # If so, check for a match
-        if cached_certs:
-            max_count = 0
-            most_frequent_cert = None
-            for cached_fingerprint, first, last, count in cached_certs:
-                if count > max_count:
-                    max_count = count
-                    most_frequent_cert = cached_fingerprint
-                if fingerprint == cached_fingerprint:
-                    # Matched!
-                    self._debug("TOFU: Accepting previously seen ({} times) certificate {}".format(count, fingerprint))
-                    self.db_cur.execute("""UPDATE cert_cache
-                        SET last_seen=?, count=?
-                        WHERE hostname=? AND address=? AND fingerprint=?""",
-                        (now, count+1, host, address, fingerprint))
-                    self.db_conn.commit()
-                    break
-            else:
-                if _HAS_CRYPTOGRAPHY:
-                    # Load the most frequently seen certificate to see if it has
-                    # expired
-                    certdir = os.path.join(self.config_dir, "cert_cache")
-                    with open(os.path.join(certdir, most_frequent_cert+".crt"), "rb") as fp:
+        fingerprint = hashlib.sha256(cert).hexdigest()
+
+        # Did we already accept this exact certificate this session?
+        if self.tofu_cache.get((host, address)) == fingerprint:
+            self.tofu_cache.move_to_end((host, address))
+            self._debug("TOFU: Accepting recently seen certificate {}".format(fingerprint))
+            self._touch_cert(host, address, fingerprint, now)
+            return
+
+        if not self.db_conn:
+            self._connect_to_tofu_db()
+
+        # Have we seen this exact certificate here before?
+        self.db_cur.execute(_SQL_SELECT_CERT, (host, address, fingerprint))
+        match = self.db_cur.fetchone()
+        if match:
+            self._debug("TOFU: Accepting previously seen ({} times) certificate {}".format(match[0], fingerprint))
+            self._touch_cert(host, address, fingerprint, now)
+            self._remember_cert(host, address, fingerprint)
+            return
+
+        # If not, have we seen any other certificate here?  Write out any
+        # queued sightings first, so the counts are up to date.
+        self._flush_cert_touches()
+        self.db_cur.execute(_SQL_SELECT_MOST_FREQUENT_CERT, (host, address))
+        most_frequent = self.db_cur.fetchone()
+        if most_frequent:
+            most_frequent_cert, max_count = most_frequent
+            if _HAS_CRYPTOGRAPHY:
+                # Load the most frequently seen certificate to see if it has
+                # expired
+                previous_expiry = self.cert_expiry_cache.get(most_frequent_cert)
+                if previous_expiry is None:
+                    # Certificates are small, so read it in one unbuffered go
+                    with open(os.path.join(self.cert_cache_dir, most_frequent_cert+".crt"), "rb", buffering=0) as fp:
                         previous_cert = fp.read()
                     previous_cert = x509.load_der_x509_certificate(previous_cert, _BACKEND)
-                    previous_ttl = previous_cert.not_valid_after - now
-                    print(previous_ttl)
-
-                self._debug("TOFU: Unrecognised certificate {}!  Raising the alarm...".format(fingerprint))
-                print("****************************************")
-                print("[SECURITY WARNING] Unrecognised certificate!")
-                print("The certificate presented for {} ({}) has never been seen before.".format(host, address))
-                print("This MIGHT be a Man-in-the-Middle attack.")
-                print("A different certificate has previously been seen {} times.".format(max_count))
-                if _HAS_CRYPTOGRAPHY:
-                    if previous_ttl < datetime.timedelta():
-                        print("That certificate has expired, which reduces suspicion somewhat.")
-                    else:
-                        print("That certificate is still valid for: {}".format(previous_ttl))
-                print("****************************************")
-                print("Attempt to verify the new certificate fingerprint out-of-band:")
-                print(fingerprint)
-                choice = input("Accept this new certificate? Y/N ").strip().lower()
-                if choice in ("y", "yes"):
-                    self.db_cur.execute("""INSERT INTO cert_cache
-                        VALUES (?, ?, ?, ?, ?, ?)""",
-                        (host, address, fingerprint, now, now, 1))
-                    self.db_conn.commit()
-                    with open(os.path.join(certdir, fingerprint+".crt"), "wb") as fp:
-                        fp.write(cert)
+                    previous_expiry = previous_cert.not_valid_after
+                    self.cert_expiry_cache[most_frequent_cert] = previous_expiry
+                previous_ttl = previous_expiry - now
+                self._debug("TOFU: Previous certificate expires in {}".format(previous_ttl))
+
+            self._debug("TOFU: Unrecognised certificate {}!  Raising the alarm...".format(fingerprint))
+            print("****************************************")
+            print("[SECURITY WARNING] Unrecognised certificate!")
+            print("The certificate presented for {} ({}) has never been seen before.".format(host, address))
+            print("This MIGHT be a Man-in-the-Middle attack.")
+            print("A different certificate has previously been seen {} times.".format(max_count))
+            if _HAS_CRYPTOGRAPHY:
+                if previous_ttl < datetime.timedelta():
+                    print("That certificate has expired, which reduces suspicion somewhat.")
                 else:
-                    raise Exception("TOFU Failure!")
+                    print("That certificate is still valid for: {}".format(previous_ttl))
+            print("****************************************")
+            print("Attempt to verify the new certificate fingerprint out-of-band:")
+            print(fingerprint)
+            choice = input("Accept this new certificate? Y/N ").strip().lower()
+            if choice in ("y", "yes"):
+                self._add_cert(host, address, fingerprint, cert, now)
+            else:
+                raise Exception("TOFU Failure!")
 
         # If not, cache this cert
         else:
             self._debug("TOFU: Blindly trusting first ever certificate for this host!")
-            self.db_cur.execute("""INSERT INTO cert_cache
-                VALUES (?, ?, ?, ?, ?, ?)""",
+            self._add_cert(host, address, fingerprint, cert, now)
+
+    def _add_cert(self, host, address, fingerprint, cert, now):
+        """
+        Add a newly trusted certificate to the TOFU database and the on-disk
+        certificate cache.  Any queued up sightings of other certificates are
+        written out in the same transaction, so there's only one commit.
+        """
+        if self.tofu_pending_touches:
+            self.db_cur.executemany(_SQL_TOUCH_CERT, self.tofu_pending_touches)
+            self.tofu_pending_touches = []
+        self.db_cur.execute(_SQL_INSERT_CERT,
                 (host, address, fingerprint, now, now, 1))
+        self.db_conn.commit()
+        with open(os.path.join(self.cert_cache_dir, fingerprint+".crt"), "wb") as fp:
+            fp.write(cert)
+        self._remember_cert(host, address, fingerprint)
+
+    def _touch_cert(self, host, address, fingerprint, now):
+        """
+        Record that a known certificate has been seen again.  These updates
+        are queued up and written in batches, so routine browsing doesn't
+        cost a database transaction per request.
+        """
+        self.tofu_pending_touches.append((now, host, address, fingerprint))
+        if len(self.tofu_pending_touches) >= _TOFU_BATCH_SIZE:
+            self._flush_cert_touches()
+
+    def _flush_cert_touches(self):
+        if self.tofu_pending_touches:
+            self.db_cur.executemany(_SQL_TOUCH_CERT, self.tofu_pending_touches)
             self.db_conn.commit()
-            certdir = os.path.join(self.config_dir, "cert_cache")
-            if not os.path.exists(certdir):
-                os.makedirs(certdir)
-            with open(os.path.join(certdir, fingerprint+".crt"), "wb") as fp:
-                fp.write(cert)
+            self.tofu_pending_touches = []
+
+    def _remember_cert(self, host, address, fingerprint):
+        self.tofu_cache[(host, address)] = fingerprint
+        self.tofu_cache.move_to_end((host, address))
+        if len(self.tofu_cache) > _MAX_TOFU_CACHE_SIZE:
+            self.tofu_cache.popitem(last=False)
 
     def _get_handler_cmd(self, mimetype):
         # Now look for a handler for this mimetype
         # Consider exact matches before wildcard matches
-        exact_matches = []
-        wildcard_matches = []
-        for handled_mime, cmd_str in _MIME_HANDLERS.items():
-            if "*" in handled_mime:
-                wildcard_matches.append((handled_mime, cmd_str))
+        cmd_str = _MIME_EXACT.get(mimetype)
+        if not cmd_str:
+            for pattern, cmd_str in _MIME_WILDCARDS:
+                if pattern.match(mimetype):
+                    break
             else:
-                exact_matches.append((handled_mime, cmd_str))
-        for handled_mime, cmd_str in exact_matches + wildcard_matches:
-            if fnmatch.fnmatch(mimetype, handled_mime):
-                break
-        else:
-            # Use "xdg-open" as a last resort.
-            cmd_str = "xdg-open %s"
+                # Use "xdg-open" as a last resort.
+                cmd_str = "xdg-open %s"
         self._debug("Using handler: %s" % cmd_str)
         return cmd_str
 
     def _handle_gemtext(self, body, menu_gi, display=True):
+        """
+        Render text/gemini to the index file.  The body can be either a
+        string or an iterable of lines, like an open file.
+        """
         self.index = []
         preformatted = False
         if self.idx_filename:
             os.unlink(self.idx_filename)
         tmpf = tempfile.NamedTemporaryFile("w", encoding="UTF-8", delete=False)
         self.idx_filename = tmpf.name
-        for line in body.splitlines():
-            if line.startswith("```"):
+        # Look these up once, not once per line
+        match = _LINE_RE.match
+        write = tmpf.write
+        index = self.index
+        index_append = index.append
+        format_item = self._format_geminiitem
+        from_map_line = GeminiItem.from_map_line
+        fill = self._get_filler()
+        # Formatting for line types which don't need any special handling
+        formatters = {
+            "* ": self._get_filler(initial_indent = "• ", subsequent_indent="  "),
+            ">": self._get_filler(initial_indent = "> ", subsequent_indent="> "),
+            "###": lambda text: _ANSI_H3_FMT % text,
+            "##": lambda text: _ANSI_H2_FMT % text,
+            "#": lambda text: _ANSI_H1_FMT % text,
+        }
+        if isinstance(body, str):
+            lines = _iter_lines(body)
+        else:
+            lines = (line.rstrip("\r\n") for line in body)
+        for line in lines:
+            line_type, text = match(line).groups()
+            if line_type == "```":
                 preformatted = not preformatted
             elif preformatted:
-                tmpf.write(line + "\n")
-            elif line.startswith("=>"):
+                write(line + "\n")
+            elif line_type == "=>":
                 try:
-                    gi = GeminiItem.from_map_line(line, menu_gi)
-                    self.index.append(gi)
-                    tmpf.write(self._format_geminiitem(len(self.index), gi) + "\n")
+                    gi = from_map_line(line, menu_gi)
+                    index_append(gi)
+                    write(format_item(len(index), gi) + "\n")
                 except:
                     self._debug("Skipping possible link: %s" % line)
-            elif line.startswith("* "):
-                line = line[1:].lstrip("\t ")
-                tmpf.write(textwrap.fill(line, self.options["width"],
-                    initial_indent = "• ", subsequent_indent="  ") + "\n")
-            elif line.startswith(">"):
-                line = line[1:].lstrip("\t ")
-                tmpf.write(textwrap.fill(line, self.options["width"],
-                    initial_indent = "> ", subsequent_indent="> ") + "\n")
-            elif line.startswith("###"):
-                line = line[3:].lstrip("\t ")
-                tmpf.write("\x1b[4m" + line + "\x1b[0m""\n")
-            elif line.startswith("##"):
-                line = line[2:].lstrip("\t ")
-                tmpf.write("\x1b[1m" + line + "\x1b[0m""\n")
-            elif line.startswith("#"):
-                line = line[1:].lstrip("\t ")
-                tmpf.write("\x1b[1m\x1b[4m" + line + "\x1b[0m""\n")
+            elif line_type:
+                write(formatters[line_type](text) + "\n")
             else:
-                tmpf.write(textwrap.fill(line, self.options["width"]) + "\n")
+                write(fill(line) + "\n")
         tmpf.close()
 
         self.lookup = self.index
@@ -932,22 +1265,48 @@ you'll be able to transparently follow links to Gopherspace!""")
             cmd_str = self._get_handler_cmd("text/gemini")
             subprocess.call(shlex.split(cmd_str % self.idx_filename))
 
+    def _get_filler(self, initial_indent="", subsequent_indent=""):
+        """
+        Return a function which fills a paragraph of text to the current
+        width with the given indents.  Where possible this is the fill method
+        of a TextWrapper which is kept around for reuse, rather than having
+        textwrap.fill() set up a new one for every single paragraph.
+        """
+        key = (self.options["width"], initial_indent, subsequent_indent)
+        if key not in self.fillers:
+            kwargs = {"width": self.options["width"],
+                      "initial_indent": initial_indent,
+                      "subsequent_indent": subsequent_indent}
+            # ansiwrap only offers the function interface
+            if hasattr(textwrap, "TextWrapper"):
+                self.fillers[key] = textwrap.TextWrapper(**kwargs).fill
+            else:
+                self.fillers[key] = functools.partial(textwrap.fill, **kwargs)
+        return self.fillers[key]
+
     def _format_geminiitem(self, index, gi, url=False):
-        protocol = "" if gi.scheme == "gemini" else " %s" % gi.scheme
-        line = "[%d%s] %s" % (index, protocol, gi.name or gi.url)
+        if gi.scheme == "gemini":
+            line = "[%d] %s" % (index, gi.name or gi.url)
+        else:
+            line = "[%d %s] %s" % (index, gi.scheme, gi.name or gi.url)
         if gi.name and url:
             line += " (%s)" % gi.url
         return line
 
     def _show_lookup(self, offset=0, end=None, url=False):
-        for n, gi in enumerate(self.lookup[offset:end]):
-            print(self._format_geminiitem(n+offset+1, gi, url))
+        # Build the whole listing and write it in one go, rather than
+        # printing long menus a line at a time
+        fmt = self._format_geminiitem
+        lines = [fmt(n, gi, url) for n, gi in enumerate(self.lookup[offset:end], offset+1)]
+        if lines:
+            self.stdout.write("\n".join(lines) + "\n")
 
     def _update_history(self, gi):
         # Don't duplicate
         if self.history and self.history[self.hist_index] == gi:
             return
-        self.history = self.history[0:self.hist_index+1]
+        if self.hist_index + 1 < len(self.history):
+            del self.history[self.hist_index+1:]
         self.history.append(gi)
         self.hist_index = len(self.history) - 1
 
@@ -956,13 +1315,19 @@ you'll be able to transparently follow links to Gopherspace!""")
             return
         self.log["requests"] += 1
         self.log["bytes_recvd"] += size
-        self.visited_hosts.add(address)
+        new_host = address not in self.visited_hosts
+        if new_host:
+            self.visited_hosts.add(address)
         if address[0] == socket.AF_INET:
             self.log["ipv4_requests"] += 1
             self.log["ipv4_bytes_recvd"] += size
+            if new_host:
+                self.log["ipv4_hosts"] += 1
         elif address[0] == socket.AF_INET6:
             self.log["ipv6_requests"] += 1
             self.log["ipv6_bytes_recvd"] += size
+            if new_host:
+                self.log["ipv6_hosts"] += 1
 
     def _get_active_tmpfile(self):
         if self.mime == "text/gemini":
@@ -970,9 +1335,17 @@ you'll be able to transparently follow links to Gopherspace!""")
         else:
             return self.tmp_filename
 
-    def _debug(self, debug_text):
-        if not self.options["debug"]:
-            return
+    def _set_debug(self, enabled):
+        """
+        Point self._debug at the real thing or a do-nothing function, so that
+        the many debug calls cost next to nothing when debugging is off.
+        """
+        if enabled:
+            self._debug = self._debug_impl
+        else:
+            self._debug = lambda debug_text: None
+
+    def _debug_impl(self, debug_text):
         debug_text = "\x1b[0;32m[DEBUG] " + debug_text + "\x1b[0m"
         print(debug_text)
 
@@ -1006,9 +1379,9 @@ you'll be able to transparently follow links to Gopherspace!""")
         Use `openssl` command to generate a new transient client certificate
         with 24 hours of validity.
         """
-        certdir = os.path.join(self.config_dir, "transient_certs")
+        import uuid
         name = str(uuid.uuid4())
-        self._generate_client_cert(certdir, name, transient=True)
+        self._generate_client_cert(self.transient_certs_dir, name, transient=True)
         self.active_is_transient = True
         self.transient_certs_created.append(name)
 
@@ -1017,7 +1390,7 @@ you'll be able to transparently follow links to Gopherspace!""")
         Interactively use `openssl` command to generate a new persistent client
         certificate with one year of validity.
         """
-        certdir = os.path.join(self.config_dir, "client_certs")
+        certdir = self.client_certs_dir
         print("What do you want to name this new certificate?")
         print("Answering `mycert` will create `{0}/mycert.crt` and `{0}/mycert.key`".format(certdir))
         name = input("> ")
@@ -1032,8 +1405,6 @@ you'll be able to transparently follow links to Gopherspace!""")
         transient or persistent) and save the certificate and private key to the
         specified directory with the specified basename.
         """
-        if not os.path.exists(certdir):
-            os.makedirs(certdir)
         certfile = os.path.join(certdir, basename+".crt")
         keyfile = os.path.join(certdir, basename+".key")
         cmd = "openssl req -x509 -newkey rsa:2048 -days {} -nodes -keyout {} -out {}".format(1 if transient else 365, keyfile, certfile)
@@ -1047,8 +1418,12 @@ you'll be able to transparently follow links to Gopherspace!""")
         Interactively select a previously generated client certificate and
         activate it.
         """
-        certdir = os.path.join(self.config_dir, "client_certs")
-        certs = glob.glob(os.path.join(certdir, "*.crt"))
+        try:
+            with os.scandir(self.client_certs_dir) as it:
+                certs = [e.path for e in it if e.name.endswith(".crt")
+                         and not e.name.startswith(".") and e.is_file()]
+        except FileNotFoundError:
+            certs = []
         if len(certs) == 0:
             print("There are no previously generated certificates.")
             return
@@ -1076,42 +1451,63 @@ you'll be able to transparently follow links to Gopherspace!""")
             for domain in self.active_cert_domains:
                 self.client_certs.pop(domain)
         self.client_certs["active"] = None
+        self.client_cert_contexts = {}
         self.active_cert_domains = []
         self.prompt = self.no_cert_prompt
         self.active_is_transient = False
 
     # Cmd implementation follows
 
+    def cmdloop(self, intro=None):
+        """
+        Run the command loop until the user quits, shrugging off Ctrl-C.
+        """
+        while True:
+            try:
+                return super().cmdloop(intro)
+            except KeyboardInterrupt:
+                # Interrupted at the prompt, so start the loop again
+                print("")
+                intro = None
+
+    def onecmd(self, line):
+        # Ctrl-C during a command (e.g. a slow download) just abandons that
+        # command, without having to leave and re-enter cmdloop
+        try:
+            return super().onecmd(line)
+        except KeyboardInterrupt:
+            print("")
+
     def default(self, line):
-        if line.strip() == "EOF":
+        # Try to parse numerical index for lookup table before anything else,
+        # since following links is by far the most common thing people type
+        stripped = line.strip()
+        if stripped.isdecimal():
+            n = int(stripped)
+            try:
+                gi = self.lookup[n-1]
+            except IndexError:
+                print ("Index too high!")
+                return
+
+            self.index_index = n
+            self._go_to_gi(gi)
+            return
+
+        if stripped == "EOF":
             return self.onecmd("quit")
-        elif line.strip() == "..":
+        elif stripped == "..":
             return self.do_up()
         elif line.startswith("/"):
             return self.do_search(line[1:])
 
         # Expand abbreviated commands
-        first_word = line.split()[0].strip()
+        first_word = stripped.split(None, 1)[0]
         if first_word in _ABBREVS:
             full_cmd = _ABBREVS[first_word]
-            expanded = line.replace(first_word, full_cmd, 1)
+            expanded = full_cmd + stripped[len(first_word):]
             return self.onecmd(expanded)
-
-        # Try to parse numerical index for lookup table
-        try:
-            n = int(line.strip())
-        except ValueError:
-            print("What?")
-            return
-
-        try:
-            gi = self.lookup[n-1]
-        except IndexError:
-            print ("Index too high!")
-            return
-
-        self.index_index = n
-        self._go_to_gi(gi)
+        print("What?")
 
     ### Settings
     @restricted
@@ -1159,6 +1555,11 @@ you'll be able to transparently follow links to Gopherspace!""")
                 except ValueError:
                     pass
             self.options[option] = value
+            if option == "width":
+                # Don't hang on to text wrappers for the old width
+                self.fillers = {}
+            elif option == "debug":
+                self._set_debug(value)
 
     @restricted
     def do_cert(self, line):
@@ -1200,6 +1601,7 @@ you'll be able to transparently follow links to Gopherspace!""")
         else:
             mime, handler = line.split(" ", 1)
             _MIME_HANDLERS[mime] = handler
+            _compile_mime_handlers()
             if "%s" not in handler:
                 print("Are you sure you don't want to pass the filename to the handler?")
 
@@ -1309,9 +1711,14 @@ Current tour can be listed with `tour ls` and scrubbed with `tour clear`."""
                         self.waypoints.append(gi)
                     elif len(pair) == 2:
                         # Two endpoints for a range of indices
-                        for n in range(int(pair[0]), int(pair[1]) + 1):
-                            gi = self.lookup[n-1]
-                            self.waypoints.append(gi)
+                        start, end = int(pair[0]), int(pair[1])
+                        if start < 1:
+                            print("Invalid index %d, skipping." % start)
+                            continue
+                        # Add as much of the range as exists in one go
+                        self.waypoints.extend(self.lookup[start-1:end])
+                        if end > len(self.lookup):
+                            print("Invalid index %d, skipping." % max(start, len(self.lookup) + 1))
                     else:
                         # Syntax error
                         print("Invalid use of range syntax %s, skipping" % index)
@@ -1353,14 +1760,15 @@ Use 'ls -l' to see URLs."""
 
     def do_history(self, *args):
         """Display history."""
-        self.lookup = self.history
+        # Take a copy, as the history itself is updated in place
+        self.lookup = list(self.history)
         self._show_lookup(url=True)
         self.page_index = 0
 
     def do_search(self, searchterm):
         """Search index (case insensitive)."""
-        results = [
-            gi for gi in self.lookup if searchterm.lower() in gi.name.lower()]
+        searchterm = searchterm.lower()
+        results = [gi for gi in self.lookup if searchterm in gi.name_lower]
         if results:
             self.lookup = results
             self._show_lookup()
@@ -1416,7 +1824,7 @@ Use 'ls -l' to see URLs."""
             # No arguments given at all
             # Save current item, if there is one, to a file whose name is
             # inferred from the gemini path
-            if not self.tmp_filename:
+            if not self.tmp_filename and self.unsaved_body is None:
                 print("You need to visit an item first!")
                 return
             else:
@@ -1471,7 +1879,7 @@ Use 'ls -l' to see URLs."""
             # Don't use _get_active_tmpfile() here, because we want to save the
             # "source code" of menus, not the rendered view - this way AV-98
             # can navigate to it later.
-            shutil.copyfile(self.tmp_filename, filename)
+            shutil.copyfile(self._get_tmp_file(), filename)
             print("Saved to %s" % filename)
 
         # Restore gi if necessary
@@ -1489,7 +1897,7 @@ Use 'ls -l' to see URLs."""
     def do_add(self, line):
         """Add the current URL to the bookmarks menu.
 Optionally, specify the new name for the bookmark."""
-        with open(os.path.join(self.config_dir, "bookmarks.gmi"), "a") as fp:
+        with open(self.bookmarks_file, "a") as fp:
             fp.write(self.gi.to_map_line(line))
 
     def do_bookmarks(self, line):
@@ -1497,7 +1905,7 @@ Optionally, specify the new name for the bookmark."""
 'bookmarks' shows all bookmarks.
 'bookmarks n' navigates immediately to item n in the bookmark menu.
 Bookmarks are stored using the 'add' command."""
-        bm_file = os.path.join(self.config_dir, "bookmarks.gmi")
+        bm_file = self.bookmarks_file
         if not os.path.exists(bm_file):
             print("You need to 'add' some bookmarks, first!")
             return
@@ -1506,9 +1914,8 @@ Bookmarks are stored using the 'add' command."""
             print("bookmarks command takes a single integer argument!")
             return
         with open(bm_file, "r") as fp:
-            body = fp.read()
             gi = GeminiItem("localhost/" + bm_file)
-            self._handle_gemtext(body, gi, display = not args)
+            self._handle_gemtext(fp, gi, display = not args)
             if args:
                 # Use argument as a numeric index
                 self.default(line)
@@ -1533,9 +1940,6 @@ current gemini browsing session."""
         delta = now - self.log["start_time"]
         hours, remainder = divmod(delta, 3600)
         minutes, seconds = divmod(remainder, 60)
-        # Count hosts
-        ipv4_hosts = len([host for host in self.visited_hosts if host[0] == socket.AF_INET])
-        ipv6_hosts = len([host for host in self.visited_hosts if host[0] == socket.AF_INET6])
         # Assemble lines
         lines.append(("Patrol duration", "%02d:%02d:%02d" % (hours, minutes, seconds)))
         lines.append(("Requests sent:", self.log["requests"]))
@@ -1545,45 +1949,79 @@ current gemini browsing session."""
         lines.append(("   IPv4 bytes:", self.log["ipv4_bytes_recvd"]))
         lines.append(("   IPv6 bytes:", self.log["ipv6_bytes_recvd"]))
         lines.append(("Unique hosts visited:", len(self.visited_hosts)))
-        lines.append(("   IPv4 hosts:", ipv4_hosts))
-        lines.append(("   IPv6 hosts:", ipv6_hosts))
+        lines.append(("   IPv4 hosts:", self.log["ipv4_hosts"]))
+        lines.append(("   IPv6 hosts:", self.log["ipv6_hosts"]))
         lines.append(("DNS failures:", self.log["dns_failures"]))
         lines.append(("Timeouts:", self.log["timeouts"]))
         lines.append(("Refused connections:", self.log["refused_connections"]))
         lines.append(("Reset connections:", self.log["reset_connections"]))
         lines.append(("Cache hits:", self.log["cache_hits"]))
-        # Print
-        for key, value in lines:
-            print(key.ljust(24) + str(value).rjust(8))
+        # Print, all in one go
+        self.stdout.write("".join(
+            "%-24s%8s\n" % (key, value) for key, value in lines))
 
     ### The end!
-    def do_quit(self, *args):
-        """Exit AV-98."""
+    def _cleanup(self):
+        """
+        Close the TOFU DB and delete temporary files.  Registered with atexit,
+        so this happens however AV-98 exits.
+        """
         # Close TOFU DB
-        self.db_conn.commit()
-        self.db_conn.close()
+        if self.db_conn:
+            self._flush_cert_touches()
+            if self.db_conn.in_transaction:
+                self.db_conn.commit()
+            self.db_conn.close()
+            self.db_conn = None
         # Clean up after ourself
         self._empty_cache()
-        if self.tmp_filename and os.path.exists(self.tmp_filename):
-            os.unlink(self.tmp_filename)
-        if self.idx_filename and os.path.exists(self.idx_filename):
-            os.unlink(self.idx_filename)
+        for filename in (self.tmp_filename, self.idx_filename):
+            if filename:
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass
 
-        for cert in self.transient_certs_created:
-            for ext in (".crt", ".key"):
-                certfile = os.path.join(self.config_dir, "transient_certs", cert+ext)
-                if os.path.exists(certfile):
+        if self.transient_certs_created:
+            # One pass over the directory finds whichever of the files exist
+            wanted = set(self.transient_certs_created)
+            try:
+                with os.scandir(self.transient_certs_dir) as it:
+                    certfiles = [e.path for e in it
+                                 if os.path.splitext(e.name)[0] in wanted
+                                 and e.name.endswith((".crt", ".key"))]
+            except FileNotFoundError:
+                certfiles = []
+            for certfile in certfiles:
+                try:
                     os.remove(certfile)
+                except FileNotFoundError:
+                    pass
+
+    def do_quit(self, *args):
+        """Exit AV-98."""
         print()
         print("Thank you for flying AV-98!")
         sys.exit()
 
     do_exit = do_quit
 
-# Main function
-def main():
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
 
-    # Parse args
+def _gemini_url(url):
+    if not url.startswith("gemini://"):
+        url = "gemini://" + url
+    return url
+
+def _parse_args():
+    # Plain old `av98` is the most common way to start, and there's no need
+    # to set up argparse just to find out that there are no arguments
+    if len(sys.argv) == 1:
+        return types.SimpleNamespace(bookmarks=False, tls_cert=None,
+                tls_key=None, restricted=False, version=False, url=[])
+
+    import argparse
     parser = argparse.ArgumentParser(description='A command line gemini client.')
     parser.add_argument('--bookmarks', action='store_true',
                         help='start with your list of bookmarks')
@@ -1594,7 +2032,18 @@ def main():
                         help='display version information and quit')
     parser.add_argument('url', metavar='URL', nargs='*',
                         help='start with this URL')
-    args = parser.parse_args()
+    return parser.parse_args()
+
+# Main function
+def main():
+
+    # Answer --version before paying for argparse or anything else
+    if sys.argv[1:] == ["--version"]:
+        print("AV-98 " + _VERSION)
+        sys.exit()
+
+    # Parse args
+    args = _parse_args()
 
     # Handle --version
     if args.version:
@@ -1604,22 +2053,32 @@ def main():
     # Instantiate client
     gc = GeminiClient(args.restricted)
 
+    # Being killed or losing the terminal should still run the atexit
+    # cleanup, so that queued TOFU updates make it into the database
+    for signame in ("SIGTERM", "SIGHUP"):
+        if hasattr(signal, signame):
+            signal.signal(getattr(signal, signame), _exit_on_signal)
+
     # Process config file
-    rcfile = os.path.join(gc.config_dir, "av98rc")
-    if os.path.exists(rcfile):
+    rcfile = gc.rc_file
+    try:
+        # It's a small file, so read and decode it all in one go
+        with open(rcfile, "rb") as fp:
+            rc_data = fp.read()
+    except FileNotFoundError:
+        pass
+    else:
         print("Using config %s" % rcfile)
-        with open(rcfile, "r") as fp:
-            for line in fp:
-                line = line.strip()
-                if ((args.bookmarks or args.url) and
-                    any((line.startswith(x) for x in ("go", "g", "tour", "t")))
-                   ):
-                    if args.bookmarks:
-                        print("Skipping rc command \"%s\" due to --bookmarks option." % line)
-                    else:
-                        print("Skipping rc command \"%s\" due to provided URLs." % line)
-                    continue
-                gc.cmdqueue.append(line)
+        skip_nav = bool(args.bookmarks or args.url)
+        for line in rc_data.decode("UTF-8", "replace").splitlines():
+            line = line.strip()
+            if skip_nav and line.startswith(_RC_NAV_PREFIXES):
+                if args.bookmarks:
+                    print("Skipping rc command \"%s\" due to --bookmarks option." % line)
+                else:
+                    print("Skipping rc command \"%s\" due to provided URLs." % line)
+                continue
+            gc.cmdqueue.append(line)
 
     # Say hi
     print("Welcome to AV-98!")
@@ -1637,18 +2096,11 @@ def main():
         if len(args.url) == 1:
             gc.cmdqueue.append("go %s" % args.url[0])
         else:
-            for url in args.url:
-                if not url.startswith("gemini://"):
-                    url = "gemini://" + url
-                gc.cmdqueue.append("tour %s" % url)
+            gc.cmdqueue.extend("tour %s" % _gemini_url(url) for url in args.url)
             gc.cmdqueue.append("tour")
 
     # Endless interpret loop
-    while True:
-        try:
-            gc.cmdloop()
-        except KeyboardInterrupt:
-            print("")
+    gc.cmdloop()
 
 if __name__ == '__main__':
     main()